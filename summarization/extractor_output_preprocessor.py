@@ -3,9 +3,18 @@ output of the extractor to ready it
 for the later stages of the summarizer
 '''
 
+import bisect
+import concurrent.futures as cf
+import functools
+import hashlib
+import os
 import re
+import threading
+from collections import OrderedDict
 
-from nltk.tokenize import sent_tokenize, word_tokenize
+import numpy as np
+import torch
+from nltk.tokenize import sent_tokenize
 from sentence_transformers import SentenceTransformer
 
 from data_models.contents import ContentType
@@ -14,6 +23,120 @@ from summarization.sentence_with_attributes import SentenceWithAttributes
 from summarization.text_summarization import TextSummarizer
 from summarization.web_entity_detection import ImageDescriptionRetriever
 
+# embeddings are shared across preprocessor runs so repeated
+# text (boilerplate, common captions) is only encoded once
+# the dict is kept in least recently used order
+_EMBEDDING_CACHE = OrderedDict()
+_EMBEDDING_CACHE_LOCK = threading.Lock()
+
+# inference mode also skips autograd's version tracking
+# it is only available from torch 1.9 onwards
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+# runs of letters and digits, the same characters str.isalnum accepts
+_ALPHANUMERIC_TOKEN_REGEX = re.compile(r'[^\W_]+')
+
+# the summarizer keeps per call state on itself
+# so calls to the shared instance are serialized
+_TEXT_SUMMARIZER_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_sentence_embedding_model(
+        model_name, max_cpu_threads, quantize_on_cpu):
+    ''' loads the sentence embedding model once
+    and shares it across preprocessor instances
+    '''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    sentence_embedding_model = SentenceTransformer(model_name, device=device)
+    # half precision doubles throughput on the gpu while
+    # leaving the cosine similarities practically unchanged
+    if device == 'cuda':
+        return sentence_embedding_model.half()
+
+    torch.set_num_threads(min(max_cpu_threads, os.cpu_count() or 1))
+    if not quantize_on_cpu:
+        return sentence_embedding_model
+
+    # on the cpu int8 weights for the linear
+    # layers give a similar speedup instead
+    return torch.quantization.quantize_dynamic(
+        sentence_embedding_model,
+        {torch.nn.Linear},
+        dtype=torch.qint8,
+        inplace=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_text_summarizer():
+    ''' loads the text summarizer once and shares
+    it across preprocessor instances
+    '''
+    return TextSummarizer(priority="accuracy")
+
+
+def _tokenize_sentence(sentence):
+    ''' returns the lowercased alphanumeric tokens of the sentence'''
+    return tuple(_ALPHANUMERIC_TOKEN_REGEX.findall(sentence.lower()))
+
+
+def _tokenize_paragraph(paragraph):
+    ''' sentence and word tokenizes the paragraph and
+    returns the alphanumeric tokens of each sentence
+    '''
+    return [_tokenize_sentence(sentence)
+            for sentence in sent_tokenize(paragraph)]
+
+
+def _get_sentence_locations(tokenized_paragraphs):
+    ''' maps every tokenized sentence of the paragraphs
+    to the (paragraph index, sentence index in paragraph)
+    pairs it occurs at, in the order of occurrence
+    '''
+    sentence_locations = dict()
+    for paragraph_index, tokenized_sentences \
+            in enumerate(tokenized_paragraphs):
+        for sentence_index_in_para, tokenized_sentence \
+                in enumerate(tokenized_sentences):
+            sentence_locations.setdefault(
+                tokenized_sentence, list()).append(
+                    (paragraph_index, sentence_index_in_para))
+    return sentence_locations
+
+
+def _locate_summary_sentences(
+        tokenized_paragraphs, tokenized_summary_sentences):
+    ''' returns a list of (summary sentence index, paragraph index,
+    sentence index in paragraph) triples
+
+    Every sentence of the paragraphs is first mapped to
+    where it occurs. Since the summary is a subsequence of
+    the paragraphs, each summary sentence is then placed at
+    its first occurrence after the previous summary sentence
+    '''
+    sentence_locations = _get_sentence_locations(tokenized_paragraphs)
+
+    summary_sentence_locations = list()
+    current_location = (0, -1)
+    for summary_sentence_index, tokenized_summary_sentence \
+            in enumerate(tokenized_summary_sentences):
+        locations = sentence_locations.get(tokenized_summary_sentence)
+        if not locations:
+            # the summarizer may reword a sentence
+            # so it cannot be placed - skip it
+            continue
+
+        # first occurrence after the current location
+        location_index = bisect.bisect_right(locations, current_location)
+        if location_index == len(locations):
+            continue
+
+        current_location = locations[location_index]
+        summary_sentence_locations.append(
+            (summary_sentence_index,) + current_location)
+
+    return summary_sentence_locations
+
 
 class ExtractorOutputPreprocessor:
     ''' Class to implement the utilities for
@@ -29,6 +152,25 @@ class ExtractorOutputPreprocessor:
     # and still does not block out other content
     MAX_TITLE_LENGTH = 100
 
+    # matches numbering such as "1." or "12)" at the start of a title
+    NUMBERING_PREFIX_REGEX = re.compile('^[0-9]+[:,.)]*')
+
+    # strings are sorted by length before encoding
+    # so each batch only pads to similar lengths
+    ENCODING_BATCH_SIZE = 32
+
+    # upper bound on the threads torch uses for cpu inference
+    MAX_CPU_THREADS = 8
+
+    # int8 quantization speeds up cpu inference but changes
+    # the embeddings - off until matching is validated with it
+    QUANTIZE_EMBEDDING_MODEL_ON_CPU = False
+
+    SENTENCE_EMBEDDING_MODEL_NAME = 'bert-base-nli-stsb-mean-tokens'
+
+    # each cached embedding takes 3KB
+    MAX_CACHED_EMBEDDINGS = 10000
+
     def __init__(self, contents):
         self.content_list = contents.content_list
         self.normal_text_content_list = list()  # non-title text
@@ -36,9 +178,6 @@ class ExtractorOutputPreprocessor:
         self.media_content_list = list()  # images/gifs
         self.embedded_content_list = list()  # insta/tweets/quotes
         self.quoted_content_list = list()
-        self.text_summarizer = TextSummarizer(priority="accuracy")
-        self.sentence_embedding_model \
-            = SentenceTransformer('bert-base-nli-stsb-mean-tokens')
 
     def get_preprocessed_content(self):
         ''' Pre-processes the content
@@ -52,8 +191,25 @@ class ExtractorOutputPreprocessor:
         # strip numbering from title text
         self._strip_numbering_from_title_text()
 
-        # summarize the webpage text
-        self._summarize_text_content()
+        # the image descriptions come from a network call - fetch
+        # them in the background while the text is processed
+        with cf.ThreadPoolExecutor(max_workers=1) as executor:
+            image_descriptions_future \
+                = executor.submit(self._fetch_image_descriptions)
+
+            # summarize the webpage text
+            self._summarize_text_content()
+
+            # encode the title, summary and quote text together
+            self._encode_text_contents()
+
+            self.image_descriptions = image_descriptions_future.result()
+
+        # build the description/attribute strings for media
+        self._condense_media_descriptions_and_attributes()
+
+        # encode them together in a single pass of the model
+        self._encode_media_descriptions_and_attributes()
 
         # assemble the sentence objects
         self._make_sentence_objects()
@@ -65,7 +221,7 @@ class ExtractorOutputPreprocessor:
         self._set_sentence_objects_list_for_title_sentences()
 
         # set quote content embeddings
-        self._fetch_and_set_quote_content_embeddings()
+        self._set_quote_content_embeddings()
 
         return PreprocessedContents(
             title_text=self.title_text_objects_list,
@@ -101,6 +257,15 @@ class ExtractorOutputPreprocessor:
             elif content.content_type.is_embedded_content():
                 self.embedded_content_list.append(content)
 
+        # the normal text attributes are read repeatedly
+        # later on so keep them in parallel lists
+        self.normal_text_strings = [
+            text.text_string for text in self.normal_text_content_list]
+        self.normal_text_content_indices = [
+            text.content_index for text in self.normal_text_content_list]
+        self.normal_text_font_styles = [
+            text.font_style for text in self.normal_text_content_list]
+
     def _strip_numbering_from_title_text(self):
         for title_text in self.title_text_content_list:
             title_text.text_string \
@@ -108,26 +273,20 @@ class ExtractorOutputPreprocessor:
                     title_text.text_string)
 
     def _strip_numbering_prefix_from_text(self, text):
-        numbered_prefix_list = re.findall('^[0-9]+[:,.,)]*', text)
-        if numbered_prefix_list == []:
+        numbered_prefix = self.NUMBERING_PREFIX_REGEX.match(text)
+        if numbered_prefix is None:
             return text.strip()  # strip spaces and tabs frome ends
-        numbered_prefix = numbered_prefix_list[0]
 
-        return text[len(numbered_prefix):].strip()
+        return text[numbered_prefix.end():].strip()
 
     def _set_sentence_objects_list_for_title_sentences(self):
         ''' sets the list of title sentences objects'''
         # initialize an empty list
         self.title_text_objects_list = list()
 
-        # collect and retrieve all embeddings at once
-        embeddings = self.sentence_embedding_model.encode([
-            text.text_string for text in self.title_text_content_list
-        ])
-
         # instantiate and append the sentence object
         for title_text, embedding in zip(
-                self.title_text_content_list, embeddings):
+                self.title_text_content_list, self.title_text_embeddings):
             self.title_text_objects_list.append(
                 SentenceWithAttributes(
                     title_text.text_string,
@@ -143,60 +302,46 @@ class ExtractorOutputPreprocessor:
         '''
         Applies text summarization to the combined text in the webpage
         '''
+        # nothing to summarize - avoid loading the summarizer
+        if not self.normal_text_strings:
+            self.summarized_text = list()
+            self.count_of_summary_sentences = 0
+            self.count_of_normal_text = 0
+            return
+
         # aggregate all text from the webpage
-        webpage_text = ""
-        for text in self.normal_text_content_list:
-            webpage_text += text.text_string
+        webpage_text_parts = list()
+        for text_string in self.normal_text_strings:
+            webpage_text_parts.append(text_string)
             # if it doesnt end with a fullstop -
             # manually end it with a full stop
-            if text.text_string[-1] != '.':
-                webpage_text += '.'
-            # add a whitespace regardless
-            webpage_text += " "
+            # and add a whitespace regardless
+            if text_string[-1:] != '.':
+                webpage_text_parts.append('. ')
+            else:
+                webpage_text_parts.append(' ')
+        webpage_text = ''.join(webpage_text_parts)
 
         # sentence tokenize to get list of summary sentences
-        self.summarized_text = sent_tokenize(
-            self.text_summarizer.summarize_text(webpage_text))
+        with _TEXT_SUMMARIZER_LOCK:
+            summary = _get_text_summarizer().summarize_text(webpage_text)
+        self.summarized_text = sent_tokenize(summary)
 
         # store counts of each content type for future use
         self.count_of_summary_sentences = len(self.summarized_text)
-        self.count_of_normal_text = len(self.normal_text_content_list)
-
-    def _get_alphanumeric_tokens(self, word_tokenized_text):
-        ''' filters and returns alphanumeric tokens'''
-        return [token.lower() for token in
-                word_tokenized_text if token.isalnum()]
-
-    def _get_tokenized_and_text_object_from_index(
-            self, normal_text_index):
-        # if index out of bounds return
-        if normal_text_index >= self.count_of_normal_text:
-            return None
-
-        # first sentence tokenize the text
-        sentence_tokenized_text = sent_tokenize(
-            self.normal_text_content_list[normal_text_index].text_string
-        )
-
-        # word tokenize
-        word_tokenized_text = [
-            word_tokenize(text) for text in sentence_tokenized_text]
+        self.count_of_normal_text = len(self.normal_text_strings)
 
-        # only retain alphanumeric tokens
-        return [self._get_alphanumeric_tokens(text) for
-                text in word_tokenized_text]
-
-    def _get_tokenized_summary_sentence_from_index(
-            self, summarized_text_index):
-        # if index out of bounds return
-        if summarized_text_index >= self.count_of_summary_sentences:
-            return None
-        # only word tokenize since it is a single sentence already
-        word_tokenized_text = word_tokenize(
-            self.summarized_text[summarized_text_index])
-
-        # retain and set alphanumeric characters
-        return self._get_alphanumeric_tokens(word_tokenized_text)
+    def _tokenize_text_content(self):
+        ''' tokenizes all the normal text and
+        summary sentences together in a single pass
+        '''
+        self.tokenized_normal_text = [
+            _tokenize_paragraph(paragraph)
+            for paragraph in self.normal_text_strings
+        ]
+        self.tokenized_summarized_text = [
+            _tokenize_sentence(sentence) for sentence in self.summarized_text
+        ]
 
     def _get_sentence_object_for_summarized_sentence(
             self,
@@ -207,31 +352,14 @@ class ExtractorOutputPreprocessor:
         ''' instantiates/initializes and returns a sentence object'''
         return SentenceWithAttributes(
             self.summarized_text[summarized_text_index],
-            self.normal_text_content_list[normal_text_index].content_index,
+            self.normal_text_content_indices[normal_text_index],
             sentence_index_in_para,
             sentence_weight,
-            self.normal_text_content_list[
-                normal_text_index].font_style,
+            self.normal_text_font_styles[normal_text_index],
             self.summarized_text_embeddings[
                 summarized_text_index]
         )
 
-    def _tokenized_text_object_has_sentence(
-            self, text_object, sentence):
-        '''
-        Given the index of the text object and
-        the index of the summarized sentence -
-        checks if the summarized sentence lies
-        in the text object at that index
-
-        note that the text object is a block/collection
-        of sentences and we need to search among all
-        sentences present in that block
-        text_object : sentence and wordtokenized text object:
-        sentence : word_tokenized sentence
-        '''
-        return sentence in text_object
-
     def _make_sentence_objects(self):
         ''' Assembles the sentence objects with required attributes
 
@@ -239,80 +367,30 @@ class ExtractorOutputPreprocessor:
         webpage text. We use this fact to assemble the sentence
         objects
 
-        Maintain two running indices through each list
-        i: running index in normal text content
-        j: running index in summarized text content
-        - When the text is present at some indices i,j in the lists we
-            increment both i and j
-        - Else just increment i
+        The summary sentences are placed in the paragraphs
+        by _locate_summary_sentences
         '''
         self.sentence_objects_list = list()
 
-        # list of lists of tokenized words
-        tokenized_and_cleaned_text_object = []
-        # list of tokenized words
-        tokenized_and_cleaned_summary_sentence = []
-
-        self.running_index_in_normal_text_content = 0
-        tokenized_and_cleaned_text_object \
-            = self._get_tokenized_and_text_object_from_index(0)
-
-        self.running_index_in_summarized_text = 0
-        tokenized_and_cleaned_summary_sentence \
-            = self._get_tokenized_summary_sentence_from_index(0)
-
-        # encode all sentences together - reduces latency
-        self.summarized_text_embeddings = self.sentence_embedding_model.encode(
-            self.summarized_text)
-
-        # to assign different indices for sentences in paragraph
-        sentence_index_in_paragraph = 0
-        # step size -based on number of sentences in para
-        if tokenized_and_cleaned_text_object:
-            step_size_for_sentence_index_in_paragraph \
-                = 1 / len(tokenized_and_cleaned_text_object)
-
-        while self.running_index_in_summarized_text \
-                < self.count_of_summary_sentences and \
-                self.running_index_in_normal_text_content\
-                < self.count_of_normal_text:
-
-            if self._tokenized_text_object_has_sentence(
-                    tokenized_and_cleaned_text_object,
-                    tokenized_and_cleaned_summary_sentence):
-
-                self.sentence_objects_list.append(
-                    self._get_sentence_object_for_summarized_sentence(
-                        self.running_index_in_summarized_text,
-                        self.running_index_in_normal_text_content,
-                        sentence_index_in_paragraph,
-                        step_size_for_sentence_index_in_paragraph
-                    )
+        # tokenize everything up front so
+        # placing sentences only does lookups
+        self._tokenize_text_content()
+
+        for summarized_text_index, \
+            normal_text_index, \
+            sentence_index_in_para in _locate_summary_sentences(
+                self.tokenized_normal_text,
+                self.tokenized_summarized_text):
+
+            self.sentence_objects_list.append(
+                self._get_sentence_object_for_summarized_sentence(
+                    summarized_text_index,
+                    normal_text_index,
+                    sentence_index_in_para,
+                    # step size -based on number of sentences in para
+                    1 / len(self.tokenized_normal_text[normal_text_index])
                 )
-                self.running_index_in_summarized_text += 1
-                sentence_index_in_paragraph += 1
-                # fetch and set the new tokenized summary sentence
-                tokenized_and_cleaned_summary_sentence =\
-                    self._get_tokenized_summary_sentence_from_index(
-                        self.running_index_in_summarized_text
-                    )
-            else:
-                # only increment when the sentence is not found
-                # in the paragraph/block of normal text sentences
-                self.running_index_in_normal_text_content += 1
-                # fetch and set the new tokenized text object
-                tokenized_and_cleaned_text_object \
-                    = self._get_tokenized_and_text_object_from_index(
-                        self.running_index_in_normal_text_content)
-
-                sentence_index_in_paragraph = 0
-                # in case the index goes out of bounds None would
-                # have been returned and the loop will terminate
-                # on the next iteration - this is a safeguard
-                # agaisnst that scenario
-                if tokenized_and_cleaned_text_object is not None:
-                    step_size_for_sentence_index_in_paragraph \
-                        = 1 / len(tokenized_and_cleaned_text_object)
+            )
 
     def get_condensed_image_description(self, image_description):
         ''' Concatenates the various image descriptions into
@@ -332,40 +410,149 @@ class ExtractorOutputPreprocessor:
             return ""
         return image.img_caption
 
-    def _fetch_media_embeddings(self):
+    def _fetch_image_descriptions(self):
+        if not self.media_content_list:
+            return list()
+
         image_describer = ImageDescriptionRetriever()
-        self.image_descriptions \
-            = image_describer.get_description_for_images(
-                [media.img_url for media in self.media_content_list]
-            )
-        # fetch all image descriptions+embeddings together - reduces latency
-        self.media_description_embeddings \
-            = self.sentence_embedding_model.encode([
-                self.get_condensed_image_description(image_description)
-                for image_description in self.image_descriptions
-            ])
-
-        self.media_attribute_embeddings \
-            = self.sentence_embedding_model.encode([
-                self.get_condensed_image_attributes(image) for image in
-                self.media_content_list
-            ])
-
-    def _fetch_and_set_quote_content_embeddings(self):
-        quote_embeddings = self.sentence_embedding_model.encode(
-            [quote.q_content for quote in self.quoted_content_list]
+        return image_describer.get_description_for_images(
+            [media.img_url for media in self.media_content_list]
         )
 
+    def _condense_media_descriptions_and_attributes(self):
+        ''' builds the condensed description and attribute
+        strings of every media once so they can be shared
+        '''
+        self.condensed_media_descriptions = [
+            self.get_condensed_image_description(image_description)
+            for image_description in self.image_descriptions
+        ]
+        self.condensed_media_attributes = [
+            self.get_condensed_image_attributes(image)
+            for image in self.media_content_list
+        ]
+
+    def _encode_text_contents(self):
+        ''' Encodes the title text, summarized
+        text and quotes together
+        '''
+        (self.title_text_embeddings,
+         self.summarized_text_embeddings,
+         self.quote_embeddings) = self._encode_text_groups([
+             [text.text_string for text in self.title_text_content_list],
+             self.summarized_text,
+             [quote.q_content for quote in self.quoted_content_list]
+         ])
+
+    def _encode_media_descriptions_and_attributes(self):
+        (self.media_description_embeddings,
+         self.media_attribute_embeddings) = self._encode_text_groups([
+             self.condensed_media_descriptions,
+             self.condensed_media_attributes
+         ])
+
+    def _encode_text_groups(self, text_groups):
+        ''' Encodes all the groups of text together
+
+        A single call to the model amortizes its fixed
+        per-call overhead over all the strings. The
+        embeddings are then sliced back into their groups
+        '''
+        # flatten the groups while noting where each one starts
+        all_texts = list()
+        group_offsets = list()
+        for text_group in text_groups:
+            group_offsets.append(len(all_texts))
+            all_texts.extend(text_group)
+        group_offsets.append(len(all_texts))
+
+        embeddings = self._encode_sentences(all_texts)
+
+        return [
+            embeddings[start:end] for start, end
+            in zip(group_offsets, group_offsets[1:])
+        ]
+
+    def _get_embedding_cache_key(self, text):
+        return hashlib.sha256(
+            (self.SENTENCE_EMBEDDING_MODEL_NAME + text).encode("utf-8")
+        ).digest()
+
+    def _encode_sentences(self, texts):
+        ''' Encodes the texts, only running the model
+        for texts that are not in the embedding cache
+        '''
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        keys = [self._get_embedding_cache_key(text) for text in texts]
+
+        embeddings_by_key = dict()
+        with _EMBEDDING_CACHE_LOCK:
+            for key in keys:
+                if key in _EMBEDDING_CACHE:
+                    _EMBEDDING_CACHE.move_to_end(key)
+                    embeddings_by_key[key] = _EMBEDDING_CACHE[key]
+
+        # unique texts missing from the cache
+        texts_to_encode = dict()
+        for key, text in zip(keys, texts):
+            if key not in embeddings_by_key:
+                texts_to_encode[key] = text
+
+        if texts_to_encode:
+            new_embeddings = self._encode_sorted_by_length(
+                list(texts_to_encode.values()))
+            embeddings_by_key.update(zip(texts_to_encode, new_embeddings))
+
+            with _EMBEDDING_CACHE_LOCK:
+                # copy the rows so a cached embedding does
+                # not keep its whole batch array alive
+                for key in texts_to_encode:
+                    _EMBEDDING_CACHE[key] = embeddings_by_key[key].copy()
+                while len(_EMBEDDING_CACHE) > self.MAX_CACHED_EMBEDDINGS:
+                    _EMBEDDING_CACHE.popitem(last=False)
+
+        return np.array(
+            [embeddings_by_key[key] for key in keys], dtype=np.float32)
+
+    def _encode_sorted_by_length(self, texts):
+        ''' Encodes the texts in order of their length
+
+        Sorting groups texts of similar length into the
+        same batch so less compute is wasted on padding.
+        The embeddings are returned in the original order
+        '''
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+
+        # the model is only loaded once something needs encoding
+        sentence_embedding_model = _get_sentence_embedding_model(
+            self.SENTENCE_EMBEDDING_MODEL_NAME,
+            self.MAX_CPU_THREADS,
+            self.QUANTIZE_EMBEDDING_MODEL_ON_CPU)
+
+        with _inference_mode():
+            sorted_embeddings = sentence_embedding_model.encode(
+                [texts[i] for i in order],
+                batch_size=self.ENCODING_BATCH_SIZE,
+                convert_to_numpy=True,
+                show_progress_bar=False)
+
+        # scatter the embeddings back to their original positions
+        # the later similarity computations expect float32 values
+        embeddings = np.empty(sorted_embeddings.shape, dtype=np.float32)
+        embeddings[order] = sorted_embeddings
+        return embeddings
+
+    def _set_quote_content_embeddings(self):
         for quote, embedding in zip(
-                self.quoted_content_list, quote_embeddings):
+                self.quoted_content_list, self.quote_embeddings):
             quote.embedding = embedding
 
     def _add_media_description_and_attribute_embeddings(self):
         ''' fills the img_description_embedding/attribute
         field in the media objects
         '''
-        self._fetch_media_embeddings()
-
         for media_content,\
             media_description_embedding,\
             media_attribute_embedding,\
@@ -0,0 +1,112 @@
+''' Tests for extractor_output_preprocessor.py '''
+import numpy as np
+
+from data_models.contents import Contents
+from summarization import extractor_output_preprocessor
+from summarization.extractor_output_preprocessor import (
+    ExtractorOutputPreprocessor, _locate_summary_sentences)
+
+
+def test_summary_sentences_are_located_in_paragraphs():
+    tokenized_paragraphs = [
+        [('a', 'b'), ('c',)],
+        [('d',), ('e', 'f'), ('g',)]
+    ]
+    tokenized_summary_sentences = [('c',), ('e', 'f')]
+
+    assert _locate_summary_sentences(
+        tokenized_paragraphs, tokenized_summary_sentences) \
+        == [(0, 0, 1), (1, 1, 1)]
+
+
+def test_repeated_sentence_is_located_after_previous_sentence():
+    tokenized_paragraphs = [
+        [('a',), ('b',)],
+        [('c',)],
+        [('a',)]
+    ]
+    tokenized_summary_sentences = [('c',), ('a',)]
+
+    assert _locate_summary_sentences(
+        tokenized_paragraphs, tokenized_summary_sentences) \
+        == [(0, 1, 0), (1, 2, 0)]
+
+
+def test_summary_sentence_not_in_paragraphs_is_skipped():
+    tokenized_paragraphs = [[('a',)], [('b',)]]
+    tokenized_summary_sentences = [('x',), ('b',)]
+
+    assert _locate_summary_sentences(
+        tokenized_paragraphs, tokenized_summary_sentences) \
+        == [(1, 1, 0)]
+
+
+def test_summary_sentence_only_in_earlier_paragraph_is_skipped():
+    tokenized_paragraphs = [[('a',)], [('b',)]]
+    tokenized_summary_sentences = [('b',), ('a',)]
+
+    assert _locate_summary_sentences(
+        tokenized_paragraphs, tokenized_summary_sentences) \
+        == [(0, 1, 0)]
+
+
+def test_repeated_sentence_in_same_paragraph_is_located_at_next_occurrence():
+    tokenized_paragraphs = [[('a',), ('b',), ('a',)]]
+    tokenized_summary_sentences = [('a',), ('a',)]
+
+    assert _locate_summary_sentences(
+        tokenized_paragraphs, tokenized_summary_sentences) \
+        == [(0, 0, 0), (1, 0, 2)]
+
+
+class FakeSentenceEmbeddingModel:
+    ''' Embeds each text as [len(text), 0] and records every call'''
+
+    def __init__(self):
+        self.encoded_texts = list()
+
+    def encode(self, texts, **kwargs):
+        self.encoded_texts.append(list(texts))
+        return np.array([[len(text), 0] for text in texts], dtype=np.float32)
+
+
+def _get_preprocessor_with_fake_model(monkeypatch):
+    extractor_output_preprocessor._EMBEDDING_CACHE.clear()
+    fake_model = FakeSentenceEmbeddingModel()
+    monkeypatch.setattr(
+        extractor_output_preprocessor,
+        '_get_sentence_embedding_model',
+        lambda *args: fake_model)
+    return ExtractorOutputPreprocessor(Contents()), fake_model
+
+
+def test_embeddings_are_returned_in_input_order(monkeypatch):
+    preprocessor, _ = _get_preprocessor_with_fake_model(monkeypatch)
+
+    embeddings = preprocessor._encode_sentences(['ccc', 'a', 'bb'])
+
+    assert embeddings[:, 0].tolist() == [3, 1, 2]
+
+
+def test_duplicate_and_cached_texts_skip_the_model(monkeypatch):
+    preprocessor, fake_model = _get_preprocessor_with_fake_model(monkeypatch)
+
+    preprocessor._encode_sentences(['a', 'bb', 'a'])
+    embeddings = preprocessor._encode_sentences(['bb', 'a', 'ccc'])
+
+    assert fake_model.encoded_texts == [['a', 'bb'], ['ccc']]
+    assert embeddings[:, 0].tolist() == [2, 1, 3]
+
+
+def test_least_recently_used_embeddings_are_evicted(monkeypatch):
+    preprocessor, fake_model = _get_preprocessor_with_fake_model(monkeypatch)
+    monkeypatch.setattr(ExtractorOutputPreprocessor,
+                        'MAX_CACHED_EMBEDDINGS', 2)
+
+    preprocessor._encode_sentences(['a', 'bb'])
+    preprocessor._encode_sentences(['a'])  # 'bb' is now least recent
+    preprocessor._encode_sentences(['ccc'])
+    preprocessor._encode_sentences(['a', 'bb'])
+
+    assert len(extractor_output_preprocessor._EMBEDDING_CACHE) == 2
+    assert fake_model.encoded_texts == [['a', 'bb'], ['ccc'], ['bb']]